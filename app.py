@@ -1,17 +1,75 @@
 import streamlit as st
 import pandas as pd
-from serpapi import GoogleSearch
+import numpy as np
+import httpx
+import orjson
 from dotenv import load_dotenv
 import os
 import io
+import asyncio
+import contextlib
+import hashlib
+import re
+import time
+import bisect
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from diskcache import Cache
 from openpyxl import load_workbook
+from openpyxl.utils.cell import column_index_from_string, coordinate_from_string, get_column_letter
 
 # 環境変数の読み込み
 load_dotenv()
 
+# SerpAPIのエンドポイント
+SERPAPI_ENDPOINT = "https://serpapi.com/search.json"
+SERPAPI_ARCHIVE_ENDPOINT = "https://serpapi.com/searches/{search_id}.json"
+
+# SerpAPIの非同期モードで結果を取りに行く間隔（秒）と最大回数
+ASYNC_POLL_INTERVAL = 1.0
+ASYNC_POLL_MAX = 60
+
+# SerpAPIの検索が完了したことを示すステータス
+SEARCH_FINISHED_STATUSES = ("Success", "Cached", "Error")
+
+# 簡易的な電話番号パターン（ハイフン区切り、またはハイフンなし10〜11桁）
+PHONE_RE = re.compile(r'\d{3}-\d{4}-\d{4}|\d{2,4}-\d{2,4}-\d{4}|\d{10,11}')
+
+# 同時検索数のデフォルト値
+DEFAULT_CONCURRENCY = 10
+
+# アイドル状態の接続を保持する時間（秒）
+KEEPALIVE_EXPIRY = 30
+
+# xlsx内部のXML名前空間
+SHEET_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+# 出力ファイルの圧縮レベル（速度優先）
+ZIP_COMPRESSLEVEL = 1
+
+# 進捗表示を更新する最小間隔（秒）
+UI_UPDATE_INTERVAL = 0.1
+
+# 検索結果のディスクキャッシュ（店舗名・都道府県ごと）
+CACHE_DIR = ".serpcache"
+CACHE_TTL = 30 * 24 * 60 * 60  # 電話番号が見つかった場合は30日間保持
+CACHE_TTL_NOT_FOUND = 60 * 60  # 見つからなかった場合は1時間のみ保持
+
+# キャッシュしない結果（エラー系は次回再検索する）
+UNCACHEABLE_PREFIXES = ("エラー:", "APIエラー:", "APIキー未設定", "全てのAPIキーが上限に達しました")
+
+@st.cache_resource
+def get_cache():
+    """検索結果のディスクキャッシュを取得する（再実行のたびに開き直さないようキャッシュする）"""
+    return Cache(CACHE_DIR)
+
 # 複数のSerpAPIキーを取得（Streamlit Cloud対応）
+@st.cache_resource
 def load_api_keys():
-    """複数のSerpAPIキーを読み込む"""
+    """複数のSerpAPIキーを読み込む（再実行のたびに読み直さないようキャッシュする）"""
     api_keys = []
     
     try:
@@ -34,165 +92,584 @@ def load_api_keys():
 # APIキーリストを取得
 API_KEYS = load_api_keys()
 
-# セッションステートの初期化（現在使用中のキーのインデックス）
-if 'current_api_key_index' not in st.session_state:
-    st.session_state.current_api_key_index = 0
+# セッションステートの初期化（上限に達したキーのインデックス）
 if 'failed_api_keys' not in st.session_state:
     st.session_state.failed_api_keys = set()
 
-def get_current_api_key():
-    """現在使用可能なAPIキーを取得"""
-    if not API_KEYS:
-        return None
+class ApiKeyLimitError(Exception):
+    """APIキーが上限に達したことを示す例外"""
+
+def _is_limit_error(message):
+    """エラーメッセージがクォータ・上限エラーかどうかを判定する"""
+    message = message.lower()
+    return "quota" in message or "limit" in message or "credits" in message or "429" in message
+
+async def _fetch(session, store_name, prefecture, api_key, async_mode=False):
+    """
+    SerpAPIに検索リクエストを送信し、結果のJSONを返す
     
-    # 失敗したキーを除外して利用可能なキーを取得
-    available_keys = [key for i, key in enumerate(API_KEYS) 
-                      if i not in st.session_state.failed_api_keys]
+    Args:
+        session (httpx.AsyncClient): HTTPクライアント
+        store_name (str): 検索する店舗名
+        prefecture (str): 都道府県名
+        api_key (str): 使用するSerpAPIキー
+        async_mode (bool): SerpAPIの非同期モードで検索を登録するだけの場合True
+        
+    Returns:
+        dict: SerpAPIのレスポンス（非同期モードでは未完了の場合search_metadataのみ）
+    """
+    # 検索クエリを作成（店舗名 + 都道府県 + 電話番号）
+    search_query = f"{store_name}"
+    if prefecture and pd.notna(prefecture) and prefecture != "":
+        search_query += f" {prefecture}"
+    search_query += " 電話番号"
+    
+    params = {
+        "engine": "google",
+        "q": search_query,
+        "api_key": api_key,
+        "num": 3,  # 電話番号の抽出に使うのは上位3件のみ
+        "hl": "ja",
+        "gl": "jp"
+    }
+    if async_mode:
+        params["async"] = "true"
+    
+    resp = await session.get(SERPAPI_ENDPOINT, params=params)
+    return orjson.loads(resp.content)
+
+async def _poll_search(session, search_id, api_key):
+    """
+    非同期モードで登録した検索の現在の状態をアーカイブAPIから1回取得する
     
-    if not available_keys:
-        return None
+    Args:
+        session (httpx.AsyncClient): HTTPクライアント
+        search_id (str): 検索登録時に返されたID
+        api_key (str): 検索を登録したSerpAPIキー
+        
+    Returns:
+        dict: SerpAPIのレスポンス
+    """
+    url = SERPAPI_ARCHIVE_ENDPOINT.format(search_id=search_id)
+    resp = await session.get(url, params={"api_key": api_key})
+    return orjson.loads(resp.content)
+
+def _is_search_finished(results):
+    """SerpAPIのレスポンスが完了済み（成功・キャッシュ・エラー）かどうかを判定する"""
+    if "error" in results:
+        return True
+    return results.get("search_metadata", {}).get("status") in SEARCH_FINISHED_STATUSES
+
+def _cache_key(store_name, prefecture):
+    """店舗名と都道府県からキャッシュのキーを作成する"""
+    store = str(store_name).strip().lower()
+    pref = str(prefecture or "").strip()
+    return hashlib.blake2b(f"{store}|{pref}".encode()).hexdigest()
+
+def get_cached_phone_number(store_name, prefecture):
+    """キャッシュ済みの検索結果を取得する（なければNone）"""
+    return get_cache().get(_cache_key(store_name, prefecture))
+
+def _store_phone_number(store_name, prefecture, phone_number):
+    """検索結果をキャッシュに保存する（エラーはキャッシュせず、見つからなかった場合は短期間のみ）"""
+    key = _cache_key(store_name, prefecture)
+    cache = get_cache()
+    if phone_number == "見つかりませんでした":
+        cache.set(key, phone_number, expire=CACHE_TTL_NOT_FOUND)
+    elif not phone_number.startswith(UNCACHEABLE_PREFIXES):
+        cache.set(key, phone_number, expire=CACHE_TTL)
+
+async def search_phone_number(session, store_name, prefecture, api_key):
+    """
+    SerpAPIで電話番号を検索し、結果をキャッシュに保存する
     
-    # 現在のインデックスが範囲外なら0にリセット
-    if st.session_state.current_api_key_index >= len(API_KEYS):
-        st.session_state.current_api_key_index = 0
+    Args:
+        session (httpx.AsyncClient): HTTPクライアント
+        store_name (str): 検索する店舗名
+        prefecture (str): 都道府県名
+        api_key (str): 使用するSerpAPIキー
+        
+    Returns:
+        str: 見つかった電話番号、または見つからない場合は空文字列
+        
+    Raises:
+        ApiKeyLimitError: APIキーが上限に達した場合
+    """
+    try:
+        # SerpAPIで検索
+        results = await _fetch(session, store_name, prefecture, api_key)
+    except Exception as e:
+        phone_number = _request_error_message(e)
+    else:
+        phone_number = _extract_phone_number(results)
     
-    return API_KEYS[st.session_state.current_api_key_index]
+    _store_phone_number(store_name, prefecture, phone_number)
+    return phone_number
 
-def switch_to_next_api_key():
-    """次のAPIキーに切り替える"""
-    # 現在のキーを失敗リストに追加
-    st.session_state.failed_api_keys.add(st.session_state.current_api_key_index)
-    
-    # 次の利用可能なキーを探す
-    for i in range(len(API_KEYS)):
-        next_index = (st.session_state.current_api_key_index + 1 + i) % len(API_KEYS)
-        if next_index not in st.session_state.failed_api_keys:
-            st.session_state.current_api_key_index = next_index
-            return True
+def _request_error_message(e):
+    """
+    通信時の例外をエラーメッセージに変換する
     
-    return False  # すべてのキーが失敗
+    Raises:
+        ApiKeyLimitError: APIクォータエラーの場合（呼び出し元で次のキーに切り替える）
+    """
+    error_str = str(e)
+    if _is_limit_error(error_str):
+        raise ApiKeyLimitError(error_str) from e
+    return f"エラー: {error_str}"
 
-def search_phone_number(store_name, prefecture=""):
+def _extract_phone_number(results):
     """
-    SerpAPIを使用して店舗名と都道府県から電話番号を検索する
-    複数のAPIキーに対応し、上限に達したら自動的に次のキーに切り替える
+    SerpAPIのレスポンスから電話番号を取り出す
     
     Args:
-        store_name (str): 検索する店舗名
-        prefecture (str): 都道府県名（オプション）
+        results (dict): SerpAPIのレスポンス
         
     Returns:
         str: 見つかった電話番号、または見つからない場合は空文字列
+        
+    Raises:
+        ApiKeyLimitError: APIキーが上限に達した場合
     """
-    if not API_KEYS:
-        return "APIキー未設定"
-    
-    current_key = get_current_api_key()
-    if not current_key:
-        return "全てのAPIキーが上限に達しました"
+    # エラーチェック
+    if "error" in results:
+        error_message = results.get("error", "")
+        # クォータエラーや認証エラーの場合は呼び出し元で次のキーに切り替える
+        if _is_limit_error(error_message):
+            raise ApiKeyLimitError(error_message)
+        return f"APIエラー: {error_message}"
+    
+    # ナレッジグラフから電話番号を取得
+    if "knowledge_graph" in results:
+        kg = results["knowledge_graph"]
+        if "phone" in kg:
+            return kg["phone"]
+    
+    # ローカルパックから電話番号を取得
+    if "local_results" in results and len(results["local_results"]) > 0:
+        local_result = results["local_results"][0]
+        if "phone" in local_result:
+            return local_result["phone"]
+    
+    # オーガニック検索結果から電話番号を抽出（スニペット内）
+    # 上位3件のスニペットを改行で連結し、1回の正規表現検索で先頭の一致を取得する
+    if "organic_results" in results:
+        snippets = "\n".join(result.get("snippet", "") for result in results["organic_results"][:3])
+        match = PHONE_RE.search(snippets)
+        if match:
+            return match.group()
+    
+    return "見つかりませんでした"
+
+async def _run_all(rows, max_concurrency, on_done=None, async_mode=False):
+    """
+    検索対象をAPIキーごとのキューにラウンドロビンで振り分け、全てのキーで並行して検索する
+    キャッシュ済みの組み合わせはAPIキーを使わずにキャッシュから返す
+    上限に達したキーのキューに残った検索対象は、まだ使えるキーのキューに移す
     
-    max_retries = len(API_KEYS)  # 最大リトライ回数 = キーの数
+    非同期モードでは、ワーカーは検索の登録だけを行って次の検索対象に進み、
+    登録済みの検索はまとめて一定間隔で並行して結果を取得する
     
-    for retry in range(max_retries):
+    Args:
+        rows (list): (店舗名, 都道府県) のリスト
+        max_concurrency (int): APIキー1つあたりの同時検索数
+        on_done (callable): 1件完了するごとに呼ばれるコールバック（オプション）
+        async_mode (bool): SerpAPIの非同期モードを使う場合True
+        
+    Returns:
+        list: rowsと同じ順序の検索結果
+    """
+    results = [None] * len(rows)
+    
+    # キャッシュにある組み合わせを先に解決し、残りだけを検索する
+    misses = []
+    for pos, (store_name, prefecture) in enumerate(rows):
+        cached = get_cached_phone_number(store_name, prefecture)
+        if cached is None:
+            misses.append(pos)
+            continue
+        results[pos] = cached
+        if on_done:
+            on_done(store_name, prefecture)
+    
+    if not misses:
+        return results
+    
+    failed_keys = st.session_state.failed_api_keys
+    key_indices = [i for i in range(len(API_KEYS)) if i not in failed_keys]
+    if not key_indices:
+        message = "全てのAPIキーが上限に達しました" if API_KEYS else "APIキー未設定"
+        for pos in misses:
+            results[pos] = message
+        return results
+    
+    remaining = len(misses)
+    finished = asyncio.Event()
+    
+    queues = {k: asyncio.Queue() for k in key_indices}
+    for n, pos in enumerate(misses):
+        queues[key_indices[n % len(key_indices)]].put_nowait((pos, rows[pos]))
+    
+    # 非同期モードで登録済みの検索: (キー, HTTPクライアント, 検索対象, search_id, 取得回数)
+    polling = []
+    
+    def complete(pos, phone_number):
+        nonlocal remaining
+        results[pos] = phone_number
+        remaining -= 1
+        if on_done:
+            on_done(*rows[pos])
+        if remaining == 0:
+            finished.set()
+    
+    def requeue(item):
+        # 残りが最も少ない利用可能なキーに回す（利用可能なキーがなければ終了扱い）
+        available = [k for k in key_indices if k not in failed_keys]
+        if not available:
+            complete(item[0], "全てのAPIキーが上限に達しました")
+            return
+        queues[min(available, key=lambda k: queues[k].qsize())].put_nowait(item)
+    
+    def fail_key(k):
+        failed_keys.add(k)
+        queue = queues[k]
+        while not queue.empty():
+            requeue(queue.get_nowait())
+    
+    def resolve(k, item, response):
+        """完了済みのレスポンスから電話番号を取り出して結果を確定する"""
+        pos, (store_name, prefecture) = item
+        phone_number = _extract_phone_number(response)
+        _store_phone_number(store_name, prefecture, phone_number)
+        complete(pos, phone_number)
+    
+    async def submit(k, session, item):
+        """非同期モードで検索を登録する（登録時点で完了済みならその場で結果を確定する）"""
+        pos, (store_name, prefecture) = item
         try:
-            # 検索クエリを作成（店舗名 + 都道府県 + 電話番号）
-            search_query = f"{store_name}"
-            if prefecture and pd.notna(prefecture) and prefecture != "":
-                search_query += f" {prefecture}"
-            search_query += " 電話番号"
-            
-            # SerpAPIで検索
-            params = {
-                "engine": "google",
-                "q": search_query,
-                "api_key": current_key,
-                "num": 5,
-                "hl": "ja",
-                "gl": "jp"
-            }
-            
-            search = GoogleSearch(params)
-            results = search.get_dict()
-            
-            # エラーチェック
-            if "error" in results:
-                error_message = results.get("error", "")
-                # クォータエラーや認証エラーの場合は次のキーに切り替え
-                if "quota" in error_message.lower() or "limit" in error_message.lower() or "credits" in error_message.lower():
-                    if switch_to_next_api_key():
-                        current_key = get_current_api_key()
-                        continue  # 次のキーでリトライ
-                    else:
-                        return "全てのAPIキーが上限に達しました"
-                else:
-                    return f"APIエラー: {error_message}"
-            
-            # ナレッジグラフから電話番号を取得
-            if "knowledge_graph" in results:
-                kg = results["knowledge_graph"]
-                if "phone" in kg:
-                    return kg["phone"]
-            
-            # ローカルパックから電話番号を取得
-            if "local_results" in results and len(results["local_results"]) > 0:
-                local_result = results["local_results"][0]
-                if "phone" in local_result:
-                    return local_result["phone"]
-            
-            # オーガニック検索結果から電話番号を抽出（スニペット内）
-            if "organic_results" in results:
-                for result in results["organic_results"][:3]:
-                    snippet = result.get("snippet", "")
-                    # 簡易的な電話番号パターンマッチング
-                    import re
-                    phone_patterns = [
-                        r'\d{2,4}-\d{2,4}-\d{4}',
-                        r'\d{3}-\d{4}-\d{4}',
-                        r'\d{10,11}'
-                    ]
-                    for pattern in phone_patterns:
-                        match = re.search(pattern, snippet)
-                        if match:
-                            return match.group()
-            
-            return "見つかりませんでした"
-            
+            response = await _fetch(session, store_name, prefecture, API_KEYS[k], async_mode=True)
         except Exception as e:
-            error_str = str(e)
-            # APIクォータエラーの場合は次のキーに切り替え
-            if "quota" in error_str.lower() or "limit" in error_str.lower() or "429" in error_str:
-                if switch_to_next_api_key():
-                    current_key = get_current_api_key()
-                    continue  # 次のキーでリトライ
+            complete(pos, _request_error_message(e))
+            return
+        if _is_search_finished(response):
+            resolve(k, item, response)
+        else:
+            polling.append((k, session, item, response["search_metadata"]["id"], 0))
+    
+    async def worker(k, session):
+        queue = queues[k]
+        while True:
+            item = await queue.get()
+            if k in failed_keys:
+                requeue(item)
+                continue
+            
+            pos, (store_name, prefecture) = item
+            try:
+                if async_mode:
+                    await submit(k, session, item)
                 else:
-                    return "全てのAPIキーが上限に達しました"
+                    complete(pos, await search_phone_number(session, store_name, prefecture, API_KEYS[k]))
+            except ApiKeyLimitError:
+                if k not in failed_keys:
+                    fail_key(k)
+                requeue(item)
+            except Exception as e:
+                complete(pos, f"エラー: {str(e)}")
+    
+    async def poll(k, session, item, search_id, attempts):
+        """登録済みの検索を1回取得する（未完了ならpollingに戻す）"""
+        pos = item[0]
+        try:
+            response = await _poll_search(session, search_id, API_KEYS[k])
+            if _is_search_finished(response):
+                resolve(k, item, response)
+            elif attempts + 1 >= ASYNC_POLL_MAX:
+                complete(pos, "エラー: 検索結果の取得がタイムアウトしました")
             else:
-                return f"エラー: {error_str}"
+                polling.append((k, session, item, search_id, attempts + 1))
+        except ApiKeyLimitError:
+            if k not in failed_keys:
+                fail_key(k)
+            requeue(item)
+        except Exception as e:
+            complete(pos, f"エラー: {str(e)}")
+    
+    async def poller():
+        while True:
+            await asyncio.sleep(ASYNC_POLL_INTERVAL)
+            batch = polling[:]
+            polling.clear()
+            await asyncio.gather(*(poll(*entry) for entry in batch))
+    
+    # 同時検索数と同じ数の接続をキープアライブで再利用し、TLSハンドシェイクを毎回行わない
+    limits = httpx.Limits(
+        max_connections=max_concurrency,
+        max_keepalive_connections=max_concurrency,
+        keepalive_expiry=KEEPALIVE_EXPIRY
+    )
+    
+    async with contextlib.AsyncExitStack() as stack:
+        tasks = []
+        for k in key_indices:
+            # キーごとに専用のHTTPクライアントを使う
+            session = await stack.enter_async_context(
+                httpx.AsyncClient(timeout=20, limits=limits, headers={"Connection": "keep-alive"})
+            )
+            tasks += [asyncio.create_task(worker(k, session)) for _ in range(max_concurrency)]
+        if async_mode:
+            tasks.append(asyncio.create_task(poller()))
+        
+        await finished.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
     
-    return "全てのAPIキーが上限に達しました"
+    return results
+
+def _rows_to_dataframe(rows):
+    """
+    シートの行（値のタプル）から、1行目をヘッダーとするDataFrameを作成する
+    読み取り専用モードでは行ごとに長さが異なるため、最も長い行に合わせてNoneで埋める
+    """
+    rows = [tuple(row) for row in rows]
+    width = max(map(len, rows), default=0)
+    header = rows[0] + (None,) * (width - len(rows[0])) if rows else ()
+    # 空のヘッダーはpandasと同様に「Unnamed: n」とし、重複したヘッダーは「名前.1」「名前.2」…とする
+    columns = []
+    counts = {}
+    for i, name in enumerate(header):
+        name = name if name is not None else f"Unnamed: {i}"
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[name] = count + 1
+            name = f"{name}.{count}"
+            count = counts.get(name, 0)
+        counts[name] = count + 1
+        columns.append(name)
+    return pd.DataFrame([row + (None,) * (width - len(row)) for row in rows[1:]], columns=columns)
+
+@st.cache_data
+def read_preview(data, nrows=5):
+    """
+    「架電リスト」シートの先頭行のみを読み取り専用モードで読み込む
+    ファイルの内容ごとにキャッシュし、ボタン操作などの再実行では読み直さない
+    
+    Args:
+        data (bytes): アップロードされたExcelファイルの内容
+        nrows (int): 読み込むデータ行数
+        
+    Returns:
+        DataFrame: 先頭nrows行のデータ
+    """
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        if "架電リスト" not in wb.sheetnames:
+            raise ValueError("「架電リスト」シートが見つかりません。")
+        
+        ws = wb["架電リスト"]
+        ws.reset_dimensions()
+        return _rows_to_dataframe(ws.iter_rows(max_row=nrows + 1, values_only=True))
+    finally:
+        wb.close()
+
+def _resolve_part(source, target):
+    """リレーションのターゲットをZIP内のパスに変換する"""
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source), target))
+
+def _read_rels(zin, part):
+    """パーツのリレーション（.rels）をId→要素の辞書として読み込む"""
+    rels_path = posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels")
+    rels = ET.fromstring(zin.read(rels_path))
+    return {rel.get("Id"): rel for rel in rels.iter(f"{{{PKG_REL_NS}}}Relationship")}
+
+def _find_sheet_part(zin, sheet_name):
+    """シート名からワークシートXMLのZIP内パスを取得する"""
+    workbook_part = next(
+        _resolve_part("", rel.get("Target"))
+        for rel in _read_rels(zin, "").values()
+        if rel.get("Type", "").endswith("/officeDocument")
+    )
+    workbook_rels = _read_rels(zin, workbook_part)
+    workbook = ET.fromstring(zin.read(workbook_part))
+    for sheet in workbook.iter(f"{{{SHEET_NS}}}sheet"):
+        if sheet.get("name") == sheet_name:
+            return _resolve_part(workbook_part, workbook_rels[sheet.get(f"{{{REL_NS}}}id")].get("Target"))
+    raise KeyError(f"「{sheet_name}」シートが見つかりません。")
 
-def process_excel(uploaded_file, preview_only=False):
+def _set_cell(row, row_number, column, value):
+    """行要素の指定列のセルに文字列を書き込む（セルがなければ列順を保って追加する）"""
+    cell_tag = f"{{{SHEET_NS}}}c"
+    children = list(row)
+    target = None
+    position = len(children)
+    col = 0
+    for n, child in enumerate(children):
+        if child.tag != cell_tag:
+            continue
+        ref = child.get("r")
+        col = column_index_from_string(coordinate_from_string(ref)[0]) if ref else col + 1
+        if col == column:
+            target = child
+            break
+        if col > column:
+            position = n
+            break
+        position = n + 1
+    
+    if target is None:
+        target = ET.Element(cell_tag, r=f"{get_column_letter(column)}{row_number}")
+        row.insert(position, target)
+    
+    # 書式（s属性）は残し、値・数式・型を置き換える
+    target.attrib.pop("t", None)
+    for child in list(target):
+        target.remove(child)
+    if value is None:
+        return
+    target.set("t", "inlineStr")
+    inline = ET.SubElement(target, f"{{{SHEET_NS}}}is")
+    ET.SubElement(inline, f"{{{SHEET_NS}}}t").text = str(value)
+
+def _expand_dimension(head, column, max_row):
+    """<dimension ref="A1:J10"/> の範囲を書き込んだセルまで広げる"""
+    match = re.search(rb'(<(?:[\w.-]+:)?dimension\b[^>]*\bref=")([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?(")', head)
+    if not match:
+        return head
+    first_col, first_row = match.group(2), match.group(3)
+    last_col, last_row = match.group(4) or first_col, match.group(5) or first_row
+    last_col = max(column_index_from_string(last_col.decode()), column)
+    last_row = max(int(last_row), max_row)
+    ref = first_col + first_row + f":{get_column_letter(last_col)}{last_row}".encode()
+    return head[:match.start()] + match.group(1) + ref + match.group(6) + head[match.end():]
+
+def _restore_prefixes(element, prefixes):
+    """要素名・属性名の {名前空間URI} を、ルート要素で宣言された接頭辞に置き換える"""
+    def rename(name):
+        if name.startswith("{"):
+            uri, local = name[1:].split("}", 1)
+            if uri in prefixes:
+                return f"{prefixes[uri]}:{local}" if prefixes[uri] else local
+        return name
+    
+    for el in element.iter():
+        el.tag = rename(el.tag)
+        for key in [key for key in el.attrib if key.startswith("{")]:
+            el.attrib[rename(key)] = el.attrib.pop(key)
+
+def _patch_sheet_xml(xml, column, values):
+    """
+    ワークシートXMLのsheetData部分のみを書き換え、指定列のセルに値を書き込む
+    sheetData以外（名前空間宣言、列幅、書式設定など）は元のバイト列のまま残す
+    
+    Args:
+        xml (bytes): ワークシートXML
+        column (int): 書き込む列番号（1始まり）
+        values (dict): {Excelの行番号: 書き込む値}
+        
+    Returns:
+        bytes: 書き換え後のワークシートXML
+    """
+    root_start = re.search(rb"<((?:[\w.-]+:)?worksheet)\b[^>]*>", xml)
+    start = re.search(rb"<(?:[\w.-]+:)?sheetData\b[^>]*?(/?)>", xml)
+    if start.group(1):
+        end = start.end()
+    else:
+        end = re.compile(rb"</(?:[\w.-]+:)?sheetData>").search(xml, start.end()).end()
+    
+    # ルート要素の名前空間宣言を付けてsheetDataだけを解析する
+    doc = root_start.group() + xml[start.start():end] + b"</" + root_start.group(1) + b">"
+    prefixes = {}
+    for event, item in ET.iterparse(io.BytesIO(doc), events=("start-ns", "start")):
+        if event == "start":
+            break
+        prefixes.setdefault(item[1], item[0])
+    sheet_data = ET.fromstring(doc)[0]
+    
+    row_tag = f"{{{SHEET_NS}}}row"
+    rows = {}
+    row_number = 0
+    for row in sheet_data.iter(row_tag):
+        row_number = int(row.get("r", row_number + 1))
+        rows[row_number] = row
+    numbers = sorted(rows)
+    
+    for row_number in sorted(values):
+        row = rows.get(row_number)
+        if row is None:
+            # 行が存在しない場合は行番号順を保って追加する
+            row = ET.Element(row_tag, r=str(row_number))
+            position = bisect.bisect_left(numbers, row_number)
+            numbers.insert(position, row_number)
+            sheet_data.insert(position, row)
+            rows[row_number] = row
+        # spansは任意の最適化情報のため、列を追加した行では削除する
+        row.attrib.pop("spans", None)
+        _set_cell(row, row_number, column, values[row_number])
+    
+    # ルート要素の名前空間宣言がそのまま使えるよう、元の接頭辞付きの名前に戻して出力する
+    _restore_prefixes(sheet_data, prefixes)
+    patched = ET.tostring(sheet_data, encoding="utf-8")
+    head = _expand_dimension(xml[:start.start()], column, max(values, default=0))
+    return head + patched + xml[end:]
+
+def write_column(data, sheet_name, column, values):
+    """
+    xlsxのZIPを直接書き換え、指定シートの指定列だけを更新したファイルを作成する
+    対象シート以外のエントリ（他のシート、画像、書式など）は内容をそのままコピーする
+    
+    Args:
+        data (bytes): 元のExcelファイルの内容
+        sheet_name (str): 更新するシート名
+        column (int): 書き込む列番号（1始まり）
+        values (dict): {Excelの行番号: 書き込む値}
+        
+    Returns:
+        bytes: 更新後のExcelファイルの内容
+    """
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(data)) as zin, \
+            zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zout:
+        sheet_part = _find_sheet_part(zin, sheet_name)
+        for item in zin.infolist():
+            content = zin.read(item.filename)
+            if item.filename == sheet_part:
+                content = _patch_sheet_xml(content, column, values)
+            zout.writestr(item, content, compresslevel=ZIP_COMPRESSLEVEL)
+    return output.getvalue()
+
+def process_excel(uploaded_file, preview_only=False, max_concurrency=DEFAULT_CONCURRENCY, async_mode=False):
     """
     Excelファイルを処理し、店舗名から電話番号を検索してK列に追加する
     
     Args:
         uploaded_file: アップロードされたExcelファイル
         preview_only (bool): プレビューのみの場合True
+        max_concurrency (int): APIキー1つあたりの同時検索数
+        async_mode (bool): SerpAPIの非同期モードを使う場合True
         
     Returns:
         tuple: (処理済みDataFrame, 処理済みExcelファイル(bytes), 検索カウント, スキップカウント)
     """
-    # Excelファイルを読み込み
+    # Excelファイルを1回だけ読み込み、同じ内容を書き込み時にも使う
     uploaded_file.seek(0)
-    excel_data = pd.ExcelFile(uploaded_file)
+    data = uploaded_file.read()
     
-    # 「架電リスト」シートを読み込み
-    if "架電リスト" not in excel_data.sheet_names:
-        st.error("「架電リスト」シートが見つかりません。")
-        return None, None, 0, 0
-    
-    uploaded_file.seek(0)
-    df = pd.read_excel(uploaded_file, sheet_name="架電リスト")
+    # 値の読み取りだけなので、ブック全体のオブジェクトを作らない読み取り専用モードで開く
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        # 「架電リスト」シートを読み込み
+        if "架電リスト" not in wb.sheetnames:
+            st.error("「架電リスト」シートが見つかりません。")
+            return None, None, 0, 0
+        
+        ws = wb["架電リスト"]
+        ws.reset_dimensions()
+        df = _rows_to_dataframe(ws.values)
+    finally:
+        wb.close()
     
     # A列が「店舗名」であることを確認
     if df.columns[0] != "店舗名":
@@ -206,9 +683,9 @@ def process_excel(uploaded_file, preview_only=False):
     # K列のインデックスは10（0始まり）
     # K列の列名を確認または作成
     if len(df.columns) < 11:
-        # K列が存在しない場合は列を追加
-        for i in range(len(df.columns), 11):
-            df.insert(i, f'Unnamed_{i}', "")
+        # K列が存在しない場合は不足分の列をまとめて追加
+        missing = [f'Unnamed_{i}' for i in range(len(df.columns), 11)]
+        df[missing] = ""
     
     # K列（インデックス10）を「店舗番号」として設定
     col_k_name = df.columns[10] if len(df.columns) > 10 else '店舗番号'
@@ -224,51 +701,76 @@ def process_excel(uploaded_file, preview_only=False):
     
     # 各店舗名に対して電話番号を検索（K列が空の場合のみ）
     total_rows = len(df)
-    search_count = 0
-    skip_count = 0
     
-    for idx, row in df.iterrows():
-        store_name = row[df.columns[0]]  # A列の値
-        prefecture = row[df.columns[2]] if len(df.columns) > 2 else ""  # C列の値（都道府県）
-        current_phone = row.get('店舗番号', '')  # K列の現在の値
-        
-        # 店舗名が入力されており、かつK列（店舗番号）が空の場合のみ検索
-        if pd.notna(store_name) and store_name != "":
-            # K列が空（NaNまたは空文字列）の場合のみ検索
-            if pd.isna(current_phone) or current_phone == "":
-                search_count += 1
-                search_text = f"{store_name} {prefecture}" if pd.notna(prefecture) else store_name
-                status_text.text(f"検索中: {search_text} ({idx + 1}/{total_rows}) - 検索: {search_count}件, スキップ: {skip_count}件")
-                phone_number = search_phone_number(str(store_name), str(prefecture) if pd.notna(prefecture) else "")
-                df.at[idx, '店舗番号'] = phone_number
-            else:
-                skip_count += 1
-                status_text.text(f"スキップ: {store_name} (既に電話番号あり) ({idx + 1}/{total_rows}) - 検索: {search_count}件, スキップ: {skip_count}件")
-        
-        # プログレスバーを更新
-        progress_bar.progress((idx + 1) / total_rows)
+    # A列・C列は文字列として一括で正規化する（前後の空白を除去し、都道府県の欠損値は空文字列）
+    stores = df.iloc[:, 0].astype(str).str.strip().to_numpy()  # A列の値
+    if len(df.columns) > 2:
+        prefectures = df.iloc[:, 2].fillna("").astype(str).str.strip().to_numpy()  # C列の値（都道府県）
+    else:
+        prefectures = np.full(total_rows, "", dtype=object)
     
-    status_text.text(f"検索完了！検索: {search_count}件, スキップ: {skip_count}件")
+    # K列の値を配列として取り出す
+    if '店舗番号' in df.columns:
+        phone_col = df['店舗番号']  # K列の現在の値
+    else:
+        phone_col = pd.Series(None, index=df.index, dtype=object)
+    phones = phone_col.to_numpy(dtype=object, copy=True)
+    
+    # 店舗名が入力されており、かつK列（店舗番号）が空（NaNまたは空文字列）の行のみ検索
+    store_col = df.iloc[:, 0]
+    has_store = store_col.notna() & (stores != "")
+    phone_empty = phone_col.isna() | (phone_col.astype(str) == "")
+    needs_search = has_store & phone_empty
+    todo_idx = np.flatnonzero(needs_search.to_numpy())
+    search_count = len(todo_idx)
+    skip_count = int((has_store & ~phone_empty).sum())
+    
+    # 検索が必要な行を収集
+    todo = list(zip(todo_idx.tolist(), stores[todo_idx].tolist(), prefectures[todo_idx].tolist()))
+    
+    # 同じ（店舗名, 都道府県）の組み合わせは1回だけ検索する
+    unique_rows = list(dict.fromkeys((store_name, prefecture) for _, store_name, prefecture in todo))
+    
+    # 検索の進捗を表示するコールバック（画面更新はUI_UPDATE_INTERVAL秒に1回まで）
+    done_count = 0
+    last_update = 0.0
+    
+    def on_done(store_name, prefecture):
+        nonlocal done_count, last_update
+        done_count += 1
+        now = time.monotonic()
+        if now - last_update < UI_UPDATE_INTERVAL and done_count < len(unique_rows):
+            return
+        last_update = now
+        search_text = f"{store_name} {prefecture}" if prefecture else store_name
+        status_text.text(f"検索完了: {search_text} ({done_count}/{len(unique_rows)}) - 検索: {search_count}件, スキップ: {skip_count}件")
+        progress_bar.progress(done_count / len(unique_rows))
     
-    # 元のExcelファイルを読み込み、フォーマットと他のシートを保持
-    uploaded_file.seek(0)
-    wb = load_workbook(uploaded_file)
+    # ユニークな組み合わせを並行して検索し、結果を該当する全行のK列に書き戻す
+    if todo:
+        phone_numbers = asyncio.run(_run_all(unique_rows, max_concurrency, on_done, async_mode))
+        results = dict(zip(unique_rows, phone_numbers))
+        for i, store_name, prefecture in todo:
+            phones[i] = results[(store_name, prefecture)]
     
-    # 「架電リスト」シートを取得
-    ws = wb["架電リスト"]
+    df['店舗番号'] = phones
+    
+    progress_bar.progress(1.0)
+    status_text.text(f"検索完了！検索: {search_count}件, スキップ: {skip_count}件")
+    
+    # 検索した行がなければExcelを保存し直さず、元のファイルをそのまま返す
+    if not todo:
+        return df, data, search_count, skip_count
     
     # K列（11列目）のデータのみ更新
     k_col_idx = 11  # Excelは1始まり
-    for idx, row in df.iterrows():
-        excel_row = idx + 2  # ヘッダー行を考慮（+1）、0始まりを1始まりに（+1）
-        ws.cell(row=excel_row, column=k_col_idx, value=df.at[idx, '店舗番号'])
+    # 検索した行のみ書き込む（ヘッダー行を考慮して+2、検索していない行は元の値のまま）
+    values = {i + 2: phones[i] for i, _, _ in todo}
     
-    # Excelファイルとして出力
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    # 対象シートのXMLだけを書き換えてExcelファイルとして出力
+    output = write_column(data, "架電リスト", k_col_idx, values)
     
-    return df, output.getvalue(), search_count, skip_count
+    return df, output, search_count, skip_count
 
 def main():
     st.set_page_config(
@@ -322,6 +824,14 @@ def main():
         st.error(f"⚠️ 全てのAPIキー({len(API_KEYS)}個)が上限に達しています")
         st.info("新しいAPIキーを追加するか、翌月までお待ちください。")
     
+    # サイドバー：キャッシュ管理
+    with st.sidebar:
+        st.subheader("🗄️ 検索キャッシュ")
+        st.caption(f"キャッシュ件数: {len(get_cache())}件")
+        if st.button("キャッシュをクリア", use_container_width=True):
+            get_cache().clear()
+            st.success("キャッシュをクリアしました")
+    
     # 使い方の説明
     with st.expander("📖 使い方"):
         st.markdown("""
@@ -362,24 +872,34 @@ def main():
         
         # ファイルのプレビュー
         try:
-            uploaded_file.seek(0)
-            df_preview = pd.read_excel(uploaded_file, sheet_name="架電リスト", nrows=5)
+            df_preview = read_preview(uploaded_file.getvalue())
             st.subheader("📋 元データプレビュー（最初の5行）")
             st.dataframe(df_preview, use_container_width=True)
-            
-            # ファイルポインタを先頭に戻す
-            uploaded_file.seek(0)
         except Exception as e:
             st.error(f"プレビュー表示エラー: {str(e)}")
             return
         
+        # 同時検索数の設定
+        max_concurrency = st.slider(
+            "同時検索数（APIキーごと）",
+            min_value=1,
+            max_value=20,
+            value=DEFAULT_CONCURRENCY,
+            help="APIキー1つあたりの同時検索数です。複数のキーを設定している場合は全てのキーで並行して検索します。APIの制限に達する場合は小さくしてください"
+        )
+        async_mode = st.checkbox(
+            "SerpAPIの非同期モードを使う",
+            value=False,
+            help="検索をSerpAPI側のキューに登録し、完了後に結果を取得します。件数が多い場合に接続を待たずに検索を進められます"
+        )
+        
         # 処理ボタン
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
             if st.button("🔍 電話番号を検索", use_container_width=True, type="primary"):
                 with st.spinner("電話番号を検索中..."):
                     uploaded_file.seek(0)
-                    result_df, result_file, search_count, skip_count = process_excel(uploaded_file)
+                    result_df, result_file, search_count, skip_count = process_excel(uploaded_file, max_concurrency=max_concurrency, async_mode=async_mode)
                     
                     if result_df is not None and result_file is not None:
                         # セッションステートに保存